@@ -0,0 +1,98 @@
+import mmap
+import os
+import struct
+import time
+import zipfile
+
+# Escapes the five XML-significant characters in a single str.translate pass
+_XMLTRANS = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&apos;'})
+
+_TEMPLATE = '<?xml version="1.0" encoding="utf-8"?><ComicInfo><Title>%s</Title><Series>%s</Series></ComicInfo>'
+
+def create_comicinfo_xml(series_name, title_name):
+    """Creates the UTF-8 encoded bytes for ComicInfo.xml."""
+    return (_TEMPLATE % (title_name.translate(_XMLTRANS), series_name.translate(_XMLTRANS))).encode("utf-8")
+
+# Fixed-size zip records, see APPNOTE.TXT sections 4.3.12 and 4.3.16
+_EOCD = struct.Struct("<4s4H2LH")
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_CD_HEADER_SIZE = 46
+_CD_SIGNATURE = b"PK\x01\x02"
+_CD_NAME_LENGTH = struct.Struct("<H")
+_CD_NAME_LENGTH_OFFSET = 28
+_ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+_ZIP64_LOCATOR_SIZE = 20
+_EOCD_SEARCH_SIZE = 65536 + _EOCD.size
+
+def _scan_central_directory(mm, name):
+    """Returns whether name is in the mapped archive's central directory, or None if zipfile must parse it."""
+    size = len(mm)
+    eocd_pos = mm.rfind(_EOCD_SIGNATURE, max(0, size - _EOCD_SEARCH_SIZE))
+    if eocd_pos == -1 or eocd_pos + _EOCD.size > size:
+        return None
+    _, _, _, _, total_entries, cd_size, cd_offset, _ = _EOCD.unpack_from(mm, eocd_pos)
+    if total_entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+        return None  # Zip64
+    # Writers may add Zip64 records between the directory and the EOCD even when the classic fields fit
+    locator_pos = eocd_pos - _ZIP64_LOCATOR_SIZE
+    if locator_pos >= 0 and mm[locator_pos:locator_pos + len(_ZIP64_LOCATOR_SIGNATURE)] == _ZIP64_LOCATOR_SIGNATURE:
+        return None
+
+    # Locate the directory relative to the EOCD so archives with prepended data still work
+    cd_start = eocd_pos - cd_size
+    if cd_start < 0:
+        return None
+    if cd_size == 0:
+        return False
+    # Anything else that puts the directory somewhere unexpected must not be read as "entry missing"
+    if mm[cd_start:cd_start + len(_CD_SIGNATURE)] != _CD_SIGNATURE:
+        return None
+
+    # Search the mapped directory for the raw name instead of walking every entry; a hit only
+    # counts when it sits right after a central directory header that declares the same length
+    target = name.encode("utf-8")
+    hit = mm.find(target, cd_start, eocd_pos)
+    while hit != -1:
+        header = hit - _CD_HEADER_SIZE
+        if (
+            header >= cd_start
+            and mm[header:header + len(_CD_SIGNATURE)] == _CD_SIGNATURE
+            and _CD_NAME_LENGTH.unpack_from(mm, header + _CD_NAME_LENGTH_OFFSET)[0] == len(target)
+        ):
+            return True
+        hit = mm.find(target, hit + 1, eocd_pos)
+    return False
+
+def has_entry(filepath, name):
+    """Checks whether the zip at filepath contains name without building a ZipInfo per entry."""
+    found = None
+    with open(filepath, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            pass  # Empty file
+        else:
+            with mm:
+                found = _scan_central_directory(mm, name)
+    if found is not None:
+        return found
+    # Malformed or Zip64 archives fall back to zipfile's full parser
+    with zipfile.ZipFile(filepath, 'r') as cbz:
+        return name in cbz.namelist()
+
+def process_cbz_file(filepath, series_name):
+    """Creates ComicInfo.xml in the .cbz file if missing and returns the log entry, if any."""
+    # Peek at the central directory first; only open for append when there is something to write
+    if has_entry(filepath, "ComicInfo.xml"):
+        return None
+
+    title_name, _ = os.path.splitext(os.path.basename(filepath))
+    comicinfo_content = create_comicinfo_xml(series_name, title_name)
+    now = time.localtime()
+    # Store the tiny XML uncompressed and reuse one timestamp for the entry and the log
+    zinfo = zipfile.ZipInfo("ComicInfo.xml", date_time=now[:6])
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.external_attr = 0o600 << 16
+    with zipfile.ZipFile(filepath, 'a') as cbz:
+        cbz.writestr(zinfo, comicinfo_content)
+    return f"{time.strftime('%Y-%m-%d %H:%M:%S', now)} - Added ComicInfo.xml to {filepath}\n"
@@ -1,32 +1,68 @@
+import hashlib
+import multiprocessing
 import os
-import time
-import zipfile
+import queue
 import sqlite3
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from comicinfo import process_cbz_file
 
 # Detect if running without a TTY (e.g. Docker)
 IN_DOCKER = not os.isatty(1)
 
-def create_comicinfo_xml(series_name, title_name):
-    """Creates an XML string for ComicInfo.xml."""
-    import xml.etree.ElementTree as ET
-    comic_info = ET.Element("ComicInfo")
-    title = ET.SubElement(comic_info, "Title")
-    title.text = title_name
-    series = ET.SubElement(comic_info, "Series")
-    series.text = series_name
-    return ET.tostring(comic_info, encoding="utf-8", method="xml").decode("utf-8")
+# Serializes access to the shared SQLite connection across worker threads
+_DB_LOCK = threading.Lock()
+
+# Walker, writer and animation threads are alive when workers start, so never fork this process directly
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+_PROCESSED_FILES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS processed_files (
+        h INTEGER PRIMARY KEY,
+        filepath TEXT NOT NULL,
+        mtime INTEGER,
+        size INTEGER
+    )
+"""
+
+_INSERT_PROCESSED_FILE = "INSERT OR REPLACE INTO processed_files (h, filepath, mtime, size) VALUES (?, ?, ?, ?)"
+
+def path_hash(filepath):
+    """Returns a stable signed 64-bit hash of filepath, used as the integer primary key."""
+    digest = hashlib.blake2b(os.fsencode(filepath), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+def connect_database(db_path):
+    """Opens the long-lived connection to the tracking database, shareable across threads."""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    # These PRAGMAs are per-connection, so they belong on the connection that does the work
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
 
 def initialize_database(db_path):
     """Initializes the SQLite database to track processed files."""
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    # WAL is persisted in the database header, so later connections inherit it
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS processed_files (
-            filepath TEXT PRIMARY KEY
-        )
-    """)
-    conn.commit()
+    cursor.execute(_PROCESSED_FILES_SCHEMA)
+    # Older databases are keyed by the filepath text (and may lack fingerprints); rebuild them
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(processed_files)")}
+    if "h" not in columns:
+        fingerprint = "mtime, size" if "mtime" in columns else "NULL, NULL"
+        cursor.execute("BEGIN")
+        cursor.execute("ALTER TABLE processed_files RENAME TO processed_files_old")
+        cursor.execute(_PROCESSED_FILES_SCHEMA)
+        rows = cursor.execute(f"SELECT filepath, {fingerprint} FROM processed_files_old").fetchall()
+        cursor.executemany(_INSERT_PROCESSED_FILE, ((path_hash(fp), fp, mtime, size) for fp, mtime, size in rows))
+        cursor.execute("DROP TABLE processed_files_old")
+        cursor.execute("COMMIT")
     conn.close()
 
 def cleanup_sql_journal(data_dir):
@@ -35,39 +71,30 @@ def cleanup_sql_journal(data_dir):
         if file.endswith(".db-journal"):
             os.remove(os.path.join(data_dir, file))
 
-def is_file_processed(db_path, filepath):
-    """Checks if a file has already been processed."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM processed_files WHERE filepath = ?", (filepath,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+def load_processed_files(conn):
+    """Loads the (mtime, size) fingerprint of every processed file, keyed by path."""
+    with _DB_LOCK:
+        return {
+            filepath: (mtime, size)
+            for filepath, mtime, size in conn.execute("SELECT filepath, mtime, size FROM processed_files")
+        }
 
-def mark_files_as_processed(db_path, filepaths):
-    """Marks a batch of files as processed in the database."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.executemany("INSERT OR IGNORE INTO processed_files (filepath) VALUES (?)", [(fp,) for fp in filepaths])
-    conn.commit()
-    conn.close()
+def lookup_processed_file(conn, filepath):
+    """Returns the recorded (mtime, size) fingerprint of filepath, or None if it was never processed."""
+    with _DB_LOCK:
+        row = conn.execute(
+            "SELECT filepath, mtime, size FROM processed_files WHERE h = ?", (path_hash(filepath),)
+        ).fetchone()
+    # The hash is only a key; a colliding path is treated as unprocessed
+    if row is None or row[0] != filepath:
+        return None
+    return row[1], row[2]
 
-def process_cbz_file(filepath, log_file, db_path, processed_files_batch):
-    """Checks if ComicInfo.xml exists in the .cbz file and creates one if not."""
-    if is_file_processed(db_path, filepath):
-        return
-
-    with zipfile.ZipFile(filepath, 'a') as cbz:
-        if "ComicInfo.xml" not in cbz.namelist():
-            series_name = os.path.basename(os.path.dirname(filepath))
-            title_name, _ = os.path.splitext(os.path.basename(filepath))
-            comicinfo_content = create_comicinfo_xml(series_name, title_name)
-            cbz.writestr("ComicInfo.xml", comicinfo_content)
-            log_entry = f"{time.strftime('%Y-%m-%d %H:%M:%S')} - Added ComicInfo.xml to {filepath}\n"
-            with open(log_file, 'a') as log:
-                log.write(log_entry)
-
-    processed_files_batch.append(filepath)
+def mark_files_as_processed(conn, files):
+    """Records (filepath, mtime, size) rows as processed; the caller owns the surrounding transaction."""
+    with _DB_LOCK:
+        cursor = conn.cursor()
+        cursor.executemany(_INSERT_PROCESSED_FILE, ((path_hash(fp), fp, mtime, size) for fp, mtime, size in files))
 
 def check_log_size(log_file):
     """Checks the size of the log file and deletes it if it exceeds 50MB."""
@@ -97,32 +124,162 @@ def print_progress_bar(current, total, bar_length=40):
         bar = '=' * filled_length + '-' * (bar_length - filled_length)
         print(f"\r[{bar}] {percent:.2f}% ({current}/{total})", end="")
 
-def process_files(directory, log_file, db_path, total_files, batch_size=500):
-    """Processes .cbz files in the directory with a progress bar."""
+def commit_processed_files(conn, begin=False):
+    """Commits pending inserts, optionally opening a fresh write transaction."""
+    with _DB_LOCK:
+        conn.commit()
+        if begin:
+            conn.execute("BEGIN IMMEDIATE")
+
+_WALK_DONE = object()
+
+_CBZ_SUFFIX = ".cbz"
+_CBZ_SUFFIX_LEN = len(_CBZ_SUFFIX)
+
+def _walk_directories(directories, found, pending):
+    """Walker thread body: lists queued (path, name) directories and feeds (entry, series_name) into found."""
+    while True:
+        item = directories.get()
+        if item is None:
+            return
+        directory, series_name = item
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        with pending["lock"]:
+                            pending["count"] += 1
+                        directories.put((entry.path, entry.name))
+                    # A slice compare skips the str.endswith method lookup for every file in the tree
+                    elif entry.name[-_CBZ_SUFFIX_LEN:] == _CBZ_SUFFIX:
+                        found.put((entry, series_name))
+        except OSError:
+            # Match os.walk, which silently skips unreadable directories
+            pass
+        with pending["lock"]:
+            pending["count"] -= 1
+            if pending["count"] == 0:
+                found.put(_WALK_DONE)
+
+def iter_cbz(root, walkers=4, max_pending=10000):
+    """Yields (os.DirEntry, enclosing directory name) for every .cbz file under root, walking with a pool of threads."""
+    directories = queue.Queue()
+    found = queue.Queue(maxsize=max_pending)
+    pending = {"lock": threading.Lock(), "count": 1}
+    directories.put((root, os.path.basename(os.path.normpath(root))))
+
+    threads = [
+        threading.Thread(target=_walk_directories, args=(directories, found, pending), daemon=True)
+        for _ in range(walkers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = found.get()
+            if item is _WALK_DONE:
+                return
+            yield item
+    finally:
+        for _ in threads:
+            directories.put(None)
+        # Keep draining in case the caller stopped early and walkers are blocked on a full queue
+        while any(thread.is_alive() for thread in threads):
+            try:
+                found.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def _record_results(done, log, conn, total_files, batch_size, commit_interval, echo, errors):
+    """Writer thread body: the only thread that writes the log and the database during a scan."""
+    try:
+        _write_results(done, log, conn, total_files, batch_size, commit_interval, echo)
+    except Exception as e:
+        # Leave no transaction open for the next scan; process_files re-raises the error
+        with _DB_LOCK:
+            conn.rollback()
+        errors.append(e)
+
+def _write_results(done, log, conn, total_files, batch_size, commit_interval, echo):
+    """Drains completed futures, batching database inserts and writing log lines."""
     processed_files_batch = []
     processed_count = 0
 
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if file.endswith(".cbz"):
-                    filepath = os.path.join(root, file)
-                    if is_file_processed(db_path, filepath):
-                        continue
-                    future = executor.submit(process_cbz_file, filepath, log_file, db_path, processed_files_batch)
-                    futures.append(future)
-
-        for future in as_completed(futures):
-            processed_count += 1
-            if processed_count % 10 == 0:
-                print_progress_bar(processed_count, total_files)
-            if processed_count % batch_size == 0:
-                mark_files_as_processed(db_path, processed_files_batch)
-                processed_files_batch.clear()
-
-        if processed_files_batch:
-            mark_files_as_processed(db_path, processed_files_batch)
+    while True:
+        item = done.get()
+        if item is None:
+            break
+        filepath, fingerprint, future = item
+        processed_count += 1
+        try:
+            log_entry = future.result()
+            if log_entry:
+                # Writing ComicInfo.xml changed the file, so record its new fingerprint
+                st = os.stat(filepath)
+                fingerprint = (st.st_mtime_ns, st.st_size)
+        except Exception as e:
+            print(f"Failed to process {filepath}: {e}", flush=True)
+        else:
+            processed_files_batch.append((filepath, *fingerprint))
+            if log_entry:
+                log.write(log_entry)
+                if echo:
+                    print(log_entry.strip(), flush=True)
+        if total_files and processed_count % 10 == 0:
+            print_progress_bar(processed_count, total_files)
+        if len(processed_files_batch) >= batch_size:
+            mark_files_as_processed(conn, processed_files_batch)
+            processed_files_batch.clear()
+        if processed_count % commit_interval == 0:
+            commit_processed_files(conn, begin=True)
+
+    if processed_files_batch:
+        mark_files_as_processed(conn, processed_files_batch)
+    commit_processed_files(conn)
+
+def process_files(entries, log, conn, total_files=None, batch_size=500, commit_interval=10000, echo=False, preload=True):
+    """Processes the given .cbz files; preload=False looks fingerprints up per path so partial scans stay O(changed)."""
+    processed = load_processed_files(conn) if preload else {}
+
+    with _DB_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+
+    # Completed futures are queued to a single writer thread, so results are recorded while the walk continues
+    done = queue.Queue()
+    errors = []
+    writer = threading.Thread(
+        target=_record_results,
+        args=(done, log, conn, total_files, batch_size, commit_interval, echo, errors),
+    )
+    writer.start()
+
+    try:
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_MP_CONTEXT) as executor:
+            for entry, series_name in entries:
+                if errors:
+                    break  # Nothing would record the results
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                # Unchanged since it was last recorded, so skip without opening the archive
+                fingerprint = (st.st_mtime_ns, st.st_size)
+                known = processed.get(entry.path)
+                if known is None and not preload:
+                    known = lookup_processed_file(conn, entry.path)
+                if known == fingerprint:
+                    continue
+                processed[entry.path] = fingerprint
+                future = executor.submit(process_cbz_file, entry.path, series_name)
+                future.add_done_callback(
+                    lambda f, filepath=entry.path, fingerprint=fingerprint: done.put((filepath, fingerprint, f))
+                )
+    finally:
+        done.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
 
 def get_data_directory():
     """Reads the data directory from the DATA_DIR environment variable."""
@@ -157,17 +314,20 @@ def main():
     db_path = os.path.join(data_dir, "processed_files.db")
 
     initialize_database(db_path)
+    conn = connect_database(db_path)
     check_log_size(log_file)
 
     print(f"Log file location: {log_file}")
 
-    total_files = sum(
-        len([f for f in files if f.endswith('.cbz')])
-        for _, _, files in os.walk(manga_directory)
-    )
+    cbz_files = list(iter_cbz(manga_directory))
+    total_files = len(cbz_files)
     print(f"Total files to process: {total_files}", flush=True)
 
-    process_files(manga_directory, log_file, db_path, total_files)
+    try:
+        with open(log_file, 'a', encoding='utf-8', buffering=1 << 20) as log:
+            process_files(cbz_files, log, conn, total_files)
+    finally:
+        conn.close()
 
     print("First Scan complete!", flush=True)
 
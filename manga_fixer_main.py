@@ -1,150 +1,203 @@
+import errno
+import itertools
 import os
 import time
-import zipfile
 import threading
-import sqlite3
-
-# Detect if running without a TTY (e.g. Docker)
-IN_DOCKER = not os.isatty(1)
-
-def create_comicinfo_xml(series_name, title_name):
-    """Creates an XML string for ComicInfo.xml."""
-    import xml.etree.ElementTree as ET
-    comic_info = ET.Element("ComicInfo")
-    title = ET.SubElement(comic_info, "Title")
-    title.text = title_name
-    series = ET.SubElement(comic_info, "Series")
-    series.text = series_name
-    return ET.tostring(comic_info, encoding="utf-8", method="xml").decode("utf-8")
-
-def initialize_database(db_path):
-    """Initializes the SQLite database to track processed files."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS processed_files (
-            filepath TEXT PRIMARY KEY
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def is_file_processed(db_path, filepath):
-    """Checks if a file has already been processed."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM processed_files WHERE filepath = ?", (filepath,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
-
-def mark_file_as_processed(db_path, filepath):
-    """Marks a file as processed in the database."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO processed_files (filepath) VALUES (?)", (filepath,))
-    conn.commit()
-    conn.close()
-
-def process_cbz_file(filepath, log_file, db_path):
-    """Checks if ComicInfo.xml exists in the .cbz file and creates one if not."""
-    if is_file_processed(db_path, filepath):
-        return
-
-    with zipfile.ZipFile(filepath, 'a') as cbz:
-        if "ComicInfo.xml" not in cbz.namelist():
-            series_name = os.path.basename(os.path.dirname(filepath))
-            title_name, _ = os.path.splitext(os.path.basename(filepath))
-            comicinfo_content = create_comicinfo_xml(series_name, title_name)
-            cbz.writestr("ComicInfo.xml", comicinfo_content)
-            log_entry = f"{time.strftime('%Y-%m-%d %H:%M:%S')} - Added ComicInfo.xml to {filepath}\n"
-            print(log_entry.strip(), flush=True)
-            with open(log_file, 'a') as log:
-                log.write(log_entry)
-        # No log output for files that already have ComicInfo.xml
-
-    mark_file_as_processed(db_path, filepath)
-
-def check_log_size(log_file):
-    """Checks the size of the log file and deletes it if it exceeds 50MB."""
-    if os.path.exists(log_file):
-        if os.path.getsize(log_file) > 50 * 1024 * 1024:
-            print(f"Log file exceeds 50MB. Deleting {log_file}...")
-            os.remove(log_file)
-
-def clear_console():
-    """Clears the console screen, skipped in Docker."""
-    if not IN_DOCKER:
-        os.system('cls' if os.name == 'nt' else 'clear')
+
+from first_run_builder import (
+    IN_DOCKER,
+    check_log_size,
+    clear_console,
+    connect_database,
+    get_data_directory,
+    get_manga_directory,
+    initialize_database,
+    iter_cbz,
+    lookup_processed_file,
+    process_files,
+)
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Seconds between scans when inotify is unavailable, and the inotify read timeout otherwise
+SCAN_INTERVAL = 300
+# Even with inotify, rescan everything this often to catch changes made on the far side of network mounts
+FULL_RESCAN_INTERVAL = 60 * 60
+# Milliseconds to keep collecting events after the first one, so a batch of downloads triggers one scan
+EVENT_COALESCE_DELAY = 2000
+
+# Returned by wait_for_changes when a new directory could not be watched
+_WATCH_LIMIT_REACHED = object()
 
 def loading_animation(stop_flag):
-    """Displays a loading animation (skipped in Docker)."""
-    if IN_DOCKER:
-        return
+    """Displays a loading animation, redrawing only the status line once a second."""
+    clear_console()
+    print("Manga Metadata Fixer by HDShock\n")
     animation = ["", ".", "..", "..."]
     while not stop_flag.is_set():
         for frame in animation:
             if stop_flag.is_set():
                 break
-            clear_console()
-            print("Manga Metadata Fixer by HDShock")
-            print("\nScanning New Manga" + frame)
-            print("\n\nProcess Queue:\n\n")
-            time.sleep(0.5)
-
-def process_files(directory, log_file, db_path):
-    """Processes .cbz files in the directory."""
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".cbz"):
-                filepath = os.path.join(root, file)
-                process_cbz_file(filepath, log_file, db_path)
-
-def get_data_directory():
-    """Reads the data directory from the DATA_DIR environment variable."""
-    data_directory = os.environ.get("DATA_DIR", "/data").strip()
-    if not os.path.isdir(data_directory):
-        raise FileNotFoundError(
-            f"DATA_DIR does not exist or is not mounted: {data_directory}"
-        )
-    return data_directory
-
-def get_manga_directory():
-    """Reads the manga directory from the MANGA_DIR environment variable."""
-    manga_directory = os.environ.get("MANGA_DIR", "/manga").strip()
-    if not os.path.isdir(manga_directory):
-        raise FileNotFoundError(
-            f"MANGA_DIR does not exist or is not mounted: {manga_directory}"
+            print(f"\rScanning New Manga{frame:<3}", end="", flush=True)
+            stop_flag.wait(1.0)
+    print()
+
+def iter_changed_files(changed_files):
+    """Yields (os.DirEntry, series_name) for just the named files in each changed directory, without recursing."""
+    for directory, names in changed_files.items():
+        series_name = os.path.basename(os.path.normpath(directory))
+        try:
+            with os.scandir(directory) as it:
+                entries = [entry for entry in it if entry.name in names]
+        except OSError:
+            continue
+        for entry in entries:
+            yield entry, series_name
+
+def scan_once(directories, changed_files, log_file, conn, full_scan):
+    """Runs a single scan of the given directory trees and individually changed files."""
+    # Reopened each cycle since check_log_size may have deleted the file
+    with open(log_file, 'a', encoding='utf-8', buffering=1 << 20) as log:
+        entries = itertools.chain(
+            itertools.chain.from_iterable(iter_cbz(directory) for directory in directories),
+            iter_changed_files(changed_files),
         )
-    return manga_directory
+        process_files(entries, log, conn, echo=True, preload=full_scan)
+
+def open_inotify():
+    """Returns an INotify instance, or None when inotify is unavailable and scans fall back to polling."""
+    if INotify is None:
+        return None
+    try:
+        return INotify()
+    except OSError:
+        return None
+
+def stop_watching(inotify):
+    """Closes inotify after the watch limit was reached so scans fall back to polling."""
+    print("inotify watch limit reached, falling back to scanning every 5 minutes.", flush=True)
+    inotify.close()
+    return None
+
+def add_watches(inotify, root, watches):
+    """Watches root and every directory below it; returns False if the kernel watch limit was reached."""
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+    for directory, _, _ in os.walk(root):
+        try:
+            wd = inotify.add_watch(directory, mask)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                return False
+            continue  # Removed since os.walk listed it
+        watches[wd] = directory
+    return True
+
+def is_unchanged(conn, filepath):
+    """Checks whether filepath still matches its recorded fingerprint, e.g. after the fixer wrote to it."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return True
+    return lookup_processed_file(conn, filepath) == (st.st_mtime_ns, st.st_size)
+
+def wait_for_changes(inotify, watches, conn, last_full_scan):
+    """Blocks until .cbz files change and returns (new directories, {directory: changed file names}), or None for a full scan."""
+    if inotify is None:
+        time.sleep(SCAN_INTERVAL)
+        return None
+
+    while True:
+        events = inotify.read(timeout=SCAN_INTERVAL * 1000, read_delay=EVENT_COALESCE_DELAY)
+        new_directories = set()
+        changed_files = {}
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                return None
+            if event.mask & flags.IGNORED:
+                watches.pop(event.wd, None)
+                continue
+            directory = watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & flags.ISDIR:
+                # New or moved-in directory: watch it and scan whatever it already contains
+                path = os.path.join(directory, event.name)
+                if not add_watches(inotify, path, watches):
+                    return _WATCH_LIMIT_REACHED
+                new_directories.add(path)
+            elif event.name.endswith(".cbz") and event.name not in changed_files.get(directory, ()):
+                # Subdirectories have their own watches, so only the reported file needs rescanning.
+                # Skip the echo of our own ComicInfo.xml writes, which were recorded with their new fingerprint
+                if not is_unchanged(conn, os.path.join(directory, event.name)):
+                    changed_files.setdefault(directory, set()).add(event.name)
+        # Checked first so a steady trickle of downloads cannot postpone the full rescan forever
+        if time.monotonic() - last_full_scan >= FULL_RESCAN_INTERVAL:
+            return None
+        if new_directories or changed_files:
+            return new_directories, changed_files
 
 def main():
-    """Main function to process .cbz files in a directory tree, running every 5 minutes."""
+    """Main function to process .cbz files in a directory tree, rescanning whenever new files arrive."""
     manga_directory = get_manga_directory()
     data_dir = get_data_directory()
 
-    while True:
-        log_file = os.path.join(data_dir, "process_log.txt")
-        db_path = os.path.join(data_dir, "processed_files.db")
-
-        initialize_database(db_path)
-        check_log_size(log_file)
-
-        print("Manga Metadata Fixer by HDShock - Scanning...", flush=True)
-
-        stop_flag = threading.Event()
-        animation_thread = threading.Thread(target=loading_animation, args=(stop_flag,))
-        animation_thread.start()
-
-        try:
-            process_files(manga_directory, log_file, db_path)
-        finally:
-            stop_flag.set()
-            animation_thread.join()
-
-        print(f"Scan complete. Next run in 5 minutes. Log: {log_file}", flush=True)
-
-        time.sleep(300)
+    log_file = os.path.join(data_dir, "process_log.txt")
+    db_path = os.path.join(data_dir, "processed_files.db")
+
+    initialize_database(db_path)
+    conn = connect_database(db_path)
+
+    # Watches go in before the first scan so files that arrive during it are not missed
+    inotify = open_inotify()
+    watches = {}
+    if inotify is not None and not add_watches(inotify, manga_directory, watches):
+        inotify = stop_watching(inotify)
+
+    try:
+        changed = None
+        last_full_scan = 0
+        while True:
+            check_log_size(log_file)
+
+            full_scan = changed is None
+            if full_scan:
+                directories, changed_files = [manga_directory], {}
+                last_full_scan = time.monotonic()
+            else:
+                directories, changed_files = sorted(changed[0]), changed[1]
+
+            print("Manga Metadata Fixer by HDShock - Scanning...", flush=True)
+
+            if IN_DOCKER:
+                scan_once(directories, changed_files, log_file, conn, full_scan)
+            else:
+                stop_flag = threading.Event()
+                animation_thread = threading.Thread(target=loading_animation, args=(stop_flag,))
+                animation_thread.start()
+
+                try:
+                    scan_once(directories, changed_files, log_file, conn, full_scan)
+                finally:
+                    stop_flag.set()
+                    animation_thread.join()
+
+            if inotify is None:
+                print(f"Scan complete. Next run in 5 minutes. Log: {log_file}", flush=True)
+            else:
+                print(f"Scan complete. Watching for new manga. Log: {log_file}", flush=True)
+
+            changed = wait_for_changes(inotify, watches, conn, last_full_scan)
+            if changed is _WATCH_LIMIT_REACHED:
+                # Part of the tree is now unwatched, so stop trusting inotify entirely
+                inotify = stop_watching(inotify)
+                changed = None
+    finally:
+        if inotify is not None:
+            inotify.close()
+        conn.close()
 
 if __name__ == "__main__":
     main()